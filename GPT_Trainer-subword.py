@@ -1,16 +1,26 @@
 import os
+# Expandable segments stop the CUDA caching allocator fragmenting as models are rebuilt; must be set before torch loads
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:128')
+import gc
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 import torch.nn.utils.prune as prune
-import mmap
+from torch.utils.checkpoint import checkpoint
 import random
+import queue
+import json
+import threading
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from pytorch_lamb import Lamb
-from torch.cuda.amp import autocast, GradScaler
+from torch.amp import GradScaler
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from transformers import GPT2TokenizerFast 
 from torch.optim import AdamW
+from functools import partial
+import inspect
 
 
 # Check if CUDA is available and if so, set the device accordingly
@@ -18,6 +28,12 @@ device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 print(device)
 torch.cuda.empty_cache()
 
+# Let FP32 matmuls and convolutions use TF32 tensor cores and autotune cuDNN kernels
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision('high')
+
 # Define the parameters for the model and training
 block_size = 128
 batch_size = 24
@@ -28,11 +44,29 @@ n_embd = 640
 n_layer = 14
 n_head = 14
 dropout = 0.25
+loss_chunk_size = 1024  # tokens scored per lm_head/cross-entropy chunk when computing the loss
+
+# Attention kernels in order of preference; FlashAttention needs fp16/bf16 and a supported head size
+attention_backends = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+
+# FlashAttention kernels only serve these head sizes; others silently fall back to a slower kernel
+flash_head_sizes = (32, 64, 96, 128)
+if n_embd % n_head or n_embd // n_head not in flash_head_sizes:
+    print(f"Warning: head size {n_embd / n_head:g} (n_embd / n_head) cannot use FlashAttention, "
+          f"pick n_head so it is one of {flash_head_sizes}")
+
+# BF16 autocast (Ampere and newer) needs no loss scaling; older GPUs fall back to FP16 with a GradScaler
+use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+
+# The fused AdamW updates every parameter in a single CUDA kernel; older torch versions lack the option
+adamw_fused = torch.cuda.is_available() and 'fused' in inspect.signature(AdamW).parameters
 
 # Define the learning rates and optimizers to test
 learning_rates = [1e-4]
+n_head_grid = [5, 10, 20]  # head counts tried by hyperparameter_search; with n_embd = 640 all give FlashAttention head sizes
 optimizer_dict = {
-    'AdamW': AdamW
+    'AdamW': partial(AdamW, fused=adamw_fused)
 }
 
 # Function to encode text using subword tokenizer
@@ -46,71 +80,171 @@ vocab_size = tokenizer.vocab_size
 
 
 
-# Function to get a random chunk of encoded data from train_split.txt or val_split.txt
-def get_random_chunk(split):
-    filename = "training_data/train_split.txt" if split == 'train' else "training_data/val_split.txt"
-    with open(filename, 'rb') as f:
-        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-            file_size = len(mm)
-            start_pos = random.randint(0, file_size - block_size * batch_size)
-            mm.seek(start_pos)
-            block = mm.read(block_size * batch_size - 1)
-            decoded_block = block.decode('utf-8', errors='ignore').replace('\r', '')
-
-            # Tokenize and encode the text
-            encoded_block = tokenizer.encode(decoded_block[:1024], return_tensors='pt').squeeze(0)  # Truncate to maximum length
-
-            if encoded_block.size(0) > block_size:
-                return encoded_block
-            else:
-                print("Encoded block is too small, retrying...")
-                return get_random_chunk(split)
-
-# Function to get a batch of data
-def get_batch(split):
-    data = get_random_chunk(split)
+# Text files and this trainer's token caches; ids are stored as uint16 since the vocabulary fits in 16 bits
+data_files = {
+    'train': ("training_data/train_split.txt", "training_data/train_gpt2.bin"),
+    'val': ("training_data/val_split.txt", "training_data/val_gpt2.bin"),
+}
+cache_chunk_size = 1024 * 1024  # characters encoded at a time while building a cache
+prefetch_depth = 4  # batches kept ready per split
+cache_format = 2  # Bump whenever the way text is encoded changes, so existing caches are rebuilt
+cache_vocab = tokenizer.name_or_path  # Recorded with each cache; a different tokenizer forces a rebuild
+
+# Function to read the key a token cache was built with, None if it has none
+def read_cache_key(cache_path):
+    try:
+        with open(cache_path + '.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+# Function to read a text file in pieces of about cache_chunk_size characters that start at whitespace,
+# so no word is split across two pieces
+def read_text_chunks(text_path):
+    with open(text_path, 'r', encoding='utf-8', errors='ignore') as src:
+        carry = ''
+        while True:
+            chunk = src.read(cache_chunk_size)
+            if not chunk:
+                break
+            chunk = carry + chunk
+            cut = max(chunk.rfind(' '), chunk.rfind('\n'))
+            if cut <= 0:
+                carry = chunk  # No whitespace to cut at yet, keep reading
+                continue
+            yield chunk[:cut]
+            carry = chunk[cut:]
+        if carry:
+            yield carry
+
+# Function to tokenize a text file into a token cache and record the key it was built with
+def write_token_cache(text_path, cache_path, key):
+    print(f"Building token cache {cache_path} from {text_path}...")
+    with open(cache_path + '.tmp', 'wb') as dst:
+        for chunk in read_text_chunks(text_path):
+            ids = tokenizer.encode(chunk.replace('\r', ''))
+            np.asarray(ids, dtype=np.uint16).tofile(dst)
+    os.replace(cache_path + '.tmp', cache_path)
+    with open(cache_path + '.json', 'w', encoding='utf-8') as f:
+        json.dump(key, f)
+
+# Function to tokenize a split once and cache it on disk as a memory-mapped token array
+def build_token_cache(split):
+    text_path, cache_path = data_files[split]
+    stat = os.stat(text_path)
+    key = {'format': cache_format, 'vocab': cache_vocab, 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if not os.path.exists(cache_path) or read_cache_key(cache_path) != key:
+        write_token_cache(text_path, cache_path, key)
+
+    data = np.memmap(cache_path, dtype=np.uint16, mode='r')
+    if len(data) and data.max() >= vocab_size:
+        print(f"{cache_path} holds ids outside the vocabulary, rebuilding...")
+        del data  # Release the mapping so the file can be replaced
+        write_token_cache(text_path, cache_path, key)
+        data = np.memmap(cache_path, dtype=np.uint16, mode='r')
 
     if len(data) <= block_size:
-        raise ValueError("Data length is less than or equal to block_size, cannot generate batch.")
-
-    ix = torch.randint(0, len(data) - block_size, (batch_size,))
-    x = torch.stack([data[i:i + block_size] for i in ix])
-    y = torch.stack([data[i + 1:i + block_size + 1] for i in ix])
-    x, y = x.to(device), y.to(device)  # Move data to the correct device
-    return x, y
-
-class Head(nn.Module):
-    def __init__(self, head_size):
-        super().__init__()
-        self.key = nn.Linear(n_embd, head_size, bias=False)
-        self.query = nn.Linear(n_embd, head_size, bias=False)
-        self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)))
-        self.dropout = nn.Dropout(dropout)
-
-    def forward(self, x):
-        B, T, C = x.shape
-        k = self.key(x)
-        q = self.query(x)
-        wei = q @ k.transpose(-2, -1) * k.shape[-1] ** -0.5
-        wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf'))
-        wei = F.softmax(wei, dim=-1)
-        wei = self.dropout(wei)
-        v = self.value(x)
-        out = wei @ v
-        return out
+        raise ValueError(f"{cache_path} holds {len(data)} tokens, not enough for a block of {block_size}.")
+    return data
+
+
+train_data = build_token_cache('train')
+val_data = build_token_cache('val')
+
+# Function to sample a batch of token windows on the CPU, inputs and targets together
+def sample_batch(split, rng):
+    data = train_data if split == 'train' else val_data
+    ix = rng.integers(0, len(data) - block_size, size=batch_size)
+    # Every (block_size + 1)-token window as a strided view, gathered in one copy; inputs and targets are
+    # its first and last block_size tokens
+    windows = sliding_window_view(data, block_size + 1)
+    # Widened only to int32 here (int64 would quadruple the transfer); pinned host memory lets the copy to
+    # the GPU run asynchronously
+    batch = torch.empty((batch_size, block_size + 1), dtype=torch.int32, pin_memory=device.type == 'cuda')
+    batch.numpy()[:] = windows[ix]
+    return batch
+
+# Keeps the next batches of a split ready on a background thread so data loading overlaps with GPU compute
+class BatchPrefetcher:
+    def __init__(self, split, seed, depth=prefetch_depth):
+        self.split = split
+        # A private generator, so batch order follows the seed whatever the main thread does with np.random
+        self.rng = np.random.default_rng(seed)
+        self.batches = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self._fill, daemon=True)
+        self.worker.start()
+
+    def _fill(self):
+        try:
+            while not self.stopped.is_set():
+                self.batches.put(sample_batch(self.split, self.rng))
+        except Exception as e:
+            self.batches.put(e)  # Re-raised by the training loop instead of hanging it
+
+    def close(self):
+        self.stopped.set()
+        # Empty the queue so a worker blocked on a full queue can finish its put and see the flag
+        while True:
+            try:
+                self.batches.get_nowait()
+            except queue.Empty:
+                break
+
+    def __next__(self):
+        batch = self.batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        batch = batch.to(device, non_blocking=True).long()  # Embedding and cross-entropy want int64 ids
+        return batch[:, :-1].contiguous(), batch[:, 1:].contiguous()
+
+batch_prefetchers = {}
+
+# Function to (re)start the prefetch threads with generators derived from seed, dropping batches already queued
+def start_prefetchers(seed):
+    for prefetcher in batch_prefetchers.values():
+        prefetcher.close()
+    for i, split in enumerate(data_files):
+        batch_prefetchers[split] = BatchPrefetcher(split, seed=[seed, i])
+
+start_prefetchers(37)
+
+# Function to get the next prefetched batch of data
+def get_batch(split):
+    return next(batch_prefetchers[split])
 
 class MultiHeadAttention(nn.Module):
     def __init__(self, num_heads, head_size):
         super().__init__()
-        self.heads = nn.ModuleList([Head(head_size) for _ in range(num_heads)])
+        self.num_heads = num_heads
+        self.head_size = head_size
+        # One fused projection for query, key and value of every head
+        self.qkv = nn.Linear(n_embd, 3 * num_heads * head_size, bias=False)
         self.proj = nn.Linear(head_size * num_heads, n_embd)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
+    def forward(self, x, past_kv=None):
+        B, T, C = x.shape
+        # One GEMM for all heads, then a single reshape to (3, B, nh, T, hs)
+        qkv = self.qkv(x).view(B, T, 3, self.num_heads, self.head_size).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        attn_mask = None
+        if past_kv is not None:
+            # Incremental decoding: new tokens attend to every cached position and to the new tokens before them;
+            # a single new token may see everything, so it needs no mask at all
+            past_len = past_kv[0].size(2)
+            k = torch.cat((past_kv[0], k), dim=2)
+            v = torch.cat((past_kv[1], v), dim=2)
+            if T > 1:
+                # Built only on this rarely used path; is_causal covers the uncached one
+                attn_mask = torch.ones(T, past_len + T, dtype=torch.bool, device=q.device).tril(diagonal=past_len)
+        with sdpa_kernel(attention_backends):
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, is_causal=past_kv is None,
+                                                 dropout_p=dropout if self.training else 0.0)
+        out = out.transpose(1, 2).reshape(B, T, self.num_heads * self.head_size)
         out = self.dropout(self.proj(out))
-        return out
+        return out, (k, v)
+
 
 class FeedFoward(nn.Module):
     def __init__(self, n_embd):
@@ -134,21 +268,24 @@ class Block(nn.Module):
         self.ln1 = nn.LayerNorm(n_embd)
         self.ln2 = nn.LayerNorm(n_embd)
 
-    def forward(self, x):
-        y = self.sa(x)
+    def forward(self, x, past_kv=None):
+        y, present_kv = self.sa(x, past_kv)
         x = self.ln1(x + y)
         y = self.ffwd(x)
         x = self.ln2(x + y)
-        return x
+        return x, present_kv
 
 class GPTLanguageModel(nn.Module):
-    def __init__(self, vocab_size):
+    def __init__(self, vocab_size, n_head=n_head, use_checkpoint=False):
         super().__init__()
+        self.use_checkpoint = use_checkpoint  # Recompute block activations in backward to save memory
         self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
         self.position_embedding_table = nn.Embedding(block_size, n_embd)
-        self.blocks = nn.Sequential(*[Block(n_embd, n_head=n_head) for _ in range(n_layer)])
+        self.register_buffer('pos_ids', torch.arange(block_size), persistent=False)
+        self.blocks = nn.ModuleList([Block(n_embd, n_head=n_head) for _ in range(n_layer)])
         self.ln_f = nn.LayerNorm(n_embd)
         self.lm_head = nn.Linear(n_embd, vocab_size)
+        self.lm_head.weight = self.token_embedding_table.weight  # Tie the output projection to the input embedding
         self.apply(self._init_weights)
 
     def _init_weights(self, module):
@@ -159,24 +296,43 @@ class GPTLanguageModel(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, index, targets=None):
+    def forward(self, index, targets=None, past_kv=None):
+        # past_kv is a per-layer list of cached (key, value) pairs, None for an empty layer; it is updated in place
         B, T = index.shape
+        past_len = 0 if past_kv is None or past_kv[0] is None else past_kv[0][0].size(2)
         tok_emb = self.token_embedding_table(index)
-        pos_emb = self.position_embedding_table(torch.arange(T, device=device))
+        pos_emb = self.position_embedding_table(self.pos_ids[past_len:past_len + T])
         x = tok_emb + pos_emb
-        x = self.blocks(x)
+        for i, block in enumerate(self.blocks):
+            if self.use_checkpoint and self.training and past_kv is None:
+                x, present_kv = checkpoint(block, x, use_reentrant=False)
+            else:
+                x, present_kv = block(x, None if past_kv is None else past_kv[i])
+            if past_kv is not None:
+                past_kv[i] = present_kv
         x = self.ln_f(x)
-        logits = self.lm_head(x)
         if targets is None:
+            logits = self.lm_head(x)
             loss = None
         else:
-            B, T, C = logits.shape
-            logits = logits.view(B * T, C)
+            # Score the tokens in chunks so the full (B*T, vocab_size) logits are never materialized;
+            # each chunk's logits are recomputed in backward instead of being kept alive
+            logits = None
+            x = x.view(B * T, -1)
             targets = targets.view(B * T)
-            loss = F.cross_entropy(logits, targets)
+            loss = 0.0
+            for i in range(0, B * T, loss_chunk_size):
+                loss = loss + checkpoint(self._chunk_loss, x[i:i + loss_chunk_size], targets[i:i + loss_chunk_size],
+                                         use_reentrant=False)
+            loss = loss / (B * T)
         return logits, loss
 
-    def generate(self, index, max_new_tokens):
+    def _chunk_loss(self, x, targets):
+        return F.cross_entropy(self.lm_head(x), targets, reduction='sum')
+
+    @torch.no_grad()
+    def generate(self, index, max_new_tokens, top_k=50):
+        past_kv = None
         for _ in range(max_new_tokens):
             # Print shape of index for debugging
             print(f"Index shape: {index.shape}")  # Check the shape
@@ -190,20 +346,35 @@ class GPTLanguageModel(nn.Module):
             if index.dim() != 2:
                 raise ValueError(f"Unexpected index shape: {index.shape}. Expected 2-dimensional tensor.")
 
-            # Slice the index to get the last block_size tokens
-            index_cond = index[:, -block_size:]
-
             # Forward pass to generate the next token
-            logits, loss = self.forward(index_cond)
+            if past_kv is None or index.size(1) > block_size:
+                # Prime the cache with the last block_size tokens; once the context outgrows block_size the
+                # positions shift every step, so the window is recomputed instead of extended
+                past_kv = [None] * len(self.blocks)
+                logits, loss = self.forward(index[:, -block_size:], past_kv=past_kv)
+            else:
+                # Only the newest token needs a forward pass, earlier keys and values come from the cache
+                logits, loss = self.forward(index[:, -1:], past_kv=past_kv)
             logits = logits[:, -1, :]
-            probs = F.softmax(logits, dim=-1)
-            index_next = torch.multinomial(probs, num_samples=1)
+            # Sample among the top_k most likely tokens only, so softmax and multinomial run over k entries
+            top_logits, top_index = torch.topk(logits, k=min(top_k, logits.size(-1)), dim=-1)
+            probs = F.softmax(top_logits, dim=-1)
+            index_next = top_index.gather(-1, torch.multinomial(probs, num_samples=1))
 
             # Concatenate the generated token to index for the next iteration
             index = torch.cat((index, index_next), dim=1)
 
         return index
 
+# Function to run one forward pass under autocast and return the loss
+def train_step(model, inputs, targets):
+    with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=device.type == 'cuda'):
+        logits, loss = model(inputs, targets)
+    return loss
+
+# Compiled once so autocast entry/exit lives inside the CUDA graph; dynamo specializes it per model
+compiled_train_step = torch.compile(train_step, mode='reduce-overhead', fullgraph=False)
+
 # Function to set seed for reproducibility
 def set_seed(seed):
     random.seed(seed)
@@ -211,6 +382,7 @@ def set_seed(seed):
     torch.manual_seed(seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
+    start_prefetchers(seed)  # Batch sampling restarts from the new seed
 
 
 def freeze_layers(model, layers_to_freeze):
@@ -263,33 +435,33 @@ def train_model(epochs, learning_rates=learning_rates, optimizer_dict=optimizer_
 
             print(f"Training with optimizer: {optimizer_name}, learning rate: {lr}")
 
-            scaler = GradScaler()
+            scaler = GradScaler('cuda', enabled=not use_bf16)
             #early_stopping_patience = 5  # Adjusted early stopping patience
             plateau_count = 0
 
             for epoch in range(start_epoch, epochs + 1):
                 model.train()
-                total_loss = 0.0
+                total_loss = torch.zeros((), device=device)
 
                 for iteration in range(1, max_iters + 1):
-                    optimizer.zero_grad()  # Clear gradients
+                    optimizer.zero_grad(set_to_none=True)  # Drop gradients instead of zero-filling them
                     inputs, targets = get_batch('train')  # Get a batch of data
 
-                    with autocast():
-                        logits, loss = model(inputs, targets)  # Forward pass
+                    loss = compiled_train_step(model, inputs, targets)  # Forward pass
 
                     scaler.scale(loss).backward()  # Backward pass with scaling
+                    scaler.unscale_(optimizer)  # Clip the real gradients, not the scaled ones
                     torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)  # Gradient clipping
                     scaler.step(optimizer)  # Optimizer step
                     scaler.update()  # Update scaler
-                    total_loss += loss.item()
+                    total_loss += loss.detach()  # Stays on the device; read back only when logging
 
                     # Evaluate the model at specified intervals
                     if iteration % eval_interval == 0:
                         val_loss = evaluate_model(model)
                         print(f"Epoch [{epoch}/{epochs}], Iteration [{iteration}/{max_iters}], "
-                              f"Train Loss: {total_loss / eval_interval:.4f}, Val Loss: {val_loss:.4f}")
-                        total_loss = 0.0
+                              f"Train Loss: {total_loss.item() / eval_interval:.4f}, Val Loss: {val_loss:.4f}")
+                        total_loss.zero_()
 
                         # Check if validation loss has improved
                         if val_loss < best_val_loss:
@@ -327,6 +499,10 @@ def train_model(epochs, learning_rates=learning_rates, optimizer_dict=optimizer_
                 #if plateau_count >= early_stopping_patience:
                     #break  # Exit outer loop, stop training early
 
+            # Free this configuration's GPU memory before building the next model
+            del model, optimizer, scheduler, scaler
+            release_cuda_memory()
+
             #if plateau_count < early_stopping_patience:
                 #print(f"Completed training for optimizer: {optimizer_name}, learning rate: {lr}, "
                       #f"Best validation loss: {best_val_loss:.4f}\n")
@@ -335,19 +511,136 @@ def train_model(epochs, learning_rates=learning_rates, optimizer_dict=optimizer_
           f"Validation Loss: {best_val_loss:.4f}")
 
 
+# Function to search optimizer settings with Optuna's TPE sampler; Hyperband prunes poor trials early
+def hyperparameter_search(n_trials=50, trial_iters=3000, optimizer_dict=optimizer_dict, n_head_grid=n_head_grid):
+    import optuna  # Only the search needs optuna, so plain training runs without it installed
+
+    set_seed(37)  # Set seed for reproducibility
+
+    # Reject head counts whose head size would push attention off the FlashAttention kernels before any model is built
+    head_choices = []
+    for heads in n_head_grid:
+        if n_embd % heads == 0 and n_embd // heads in flash_head_sizes:
+            head_choices.append(heads)
+        else:
+            print(f"Skipping n_head={heads}: head size {n_embd / heads:g} cannot use FlashAttention")
+    if not head_choices:
+        raise ValueError(f"No n_head in {n_head_grid} gives a FlashAttention head size {flash_head_sizes} for n_embd={n_embd}.")
+
+    def objective(trial):
+        lr = trial.suggest_float('lr', 1e-5, 5e-3, log=True)
+        weight_decay = trial.suggest_float('weight_decay', 1e-3, 1e-1, log=True)
+        optimizer_name = trial.suggest_categorical('optimizer', list(optimizer_dict))
+        heads = trial.suggest_categorical('n_head', head_choices)
+
+        model = GPTLanguageModel(vocab_size, n_head=heads).to(device)
+        if not fits_in_vram(model):
+            # Trade an extra forward pass for activation memory before giving up on the trial
+            model.use_checkpoint = True
+            if not fits_in_vram(model):
+                print(f"Trial {trial.number} does not fit in VRAM, skipping")
+                del model
+                release_cuda_memory()
+                raise optuna.TrialPruned()
+            print(f"Trial {trial.number} uses activation checkpointing to fit in VRAM")
+
+        optimizer = optimizer_dict[optimizer_name](model.parameters(), lr=lr, weight_decay=weight_decay)
+        scaler = GradScaler('cuda', enabled=not use_bf16)
+        print(f"Trial {trial.number}: optimizer {optimizer_name}, learning rate {lr:.2e}, weight decay {weight_decay:.2e}, "
+              f"heads {heads}")
+
+        val_loss = float('inf')
+        pruned = False
+        model.train()
+        for iteration in range(1, trial_iters + 1):
+            optimizer.zero_grad(set_to_none=True)
+            inputs, targets = get_batch('train')
+
+            loss = compiled_train_step(model, inputs, targets)
+
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+            scaler.step(optimizer)
+            scaler.update()
+
+            if iteration % eval_interval == 0:
+                val_loss = evaluate_model(model)
+                model.train()
+                print(f"Trial {trial.number}, Iteration [{iteration}/{trial_iters}], Val Loss: {val_loss:.4f}")
+
+                # Let the pruner stop trials that trail the others at the same iteration
+                trial.report(val_loss, iteration)
+                if trial.should_prune():
+                    pruned = True
+                    break
+
+        # Free this trial's GPU memory before the next one builds its model
+        del model, optimizer, scaler, inputs, targets, loss
+        release_cuda_memory()
+        if pruned:
+            raise optuna.TrialPruned()
+        return val_loss
+
+    study = optuna.create_study(direction='minimize',
+                                sampler=optuna.samplers.TPESampler(seed=37),
+                                pruner=optuna.pruners.HyperbandPruner(min_resource=eval_interval, max_resource=trial_iters))
+    study.optimize(objective, n_trials=n_trials)
+
+    # best_params raises if nothing finished, e.g. every trial was pruned early or did not fit in VRAM
+    if not study.get_trials(states=(optuna.trial.TrialState.COMPLETE,)):
+        print(f"No trial completed out of {len(study.trials)}; no best hyperparameters to report.")
+        return None
+    print(f"Best hyperparameters found: {study.best_params}, Validation Loss: {study.best_value:.4f}")
+    return study.best_params
+
+
+
+# Function to dry-run one training step and check its peak memory fits in the GPU's free memory
+def fits_in_vram(model, headroom=0.9):
+    if device.type != 'cuda':
+        return True
+
+    # Hand back blocks the allocator still caches (e.g. from an earlier probe or OOM) so they count as free
+    gc.collect()
+    torch.cuda.empty_cache()
+    free_bytes, _ = torch.cuda.mem_get_info()
+    torch.cuda.reset_peak_memory_stats()
+    start_bytes = torch.cuda.memory_allocated()
+    try:
+        inputs, targets = get_batch('train')
+        loss = train_step(model, inputs, targets)  # Eager, so the probe does not trigger a compile
+        loss.backward()
+        peak_bytes = torch.cuda.max_memory_allocated() - start_bytes
+    except torch.cuda.OutOfMemoryError:
+        return False
+    finally:
+        model.zero_grad(set_to_none=True)
+
+    # Optimizer state is created on the first step, so budget two moment buffers per parameter
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    return peak_bytes + 2 * param_bytes < headroom * free_bytes
+
+# Function to release a finished configuration's GPU memory so the next one starts unfragmented
+def release_cuda_memory():
+    torch._dynamo.reset()  # Compiled graphs hold on to their CUDA graph memory pools
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
 
 # Function to evaluate the model on validation set
 def evaluate_model(model):
     model.eval()  # Set the model to evaluation mode
-    total_loss = 0.0
+    total_loss = torch.zeros((), device=device)  # Accumulated on the device to avoid a sync per batch
 
     with torch.no_grad():
         for _ in range(eval_iters):
             inputs, targets = get_batch('val')  # Get a batch of validation data
-            logits, loss = model(inputs, targets)  # Forward pass
-            total_loss += loss.item()
+            loss = compiled_train_step(model, inputs, targets)  # Forward pass
+            total_loss += loss.detach()
 
-    return total_loss / eval_iters
+    return (total_loss / eval_iters).item()
 
 # Function to save model checkpoint
 def save_checkpoint(model, optimizer, epoch, val_loss, checkpoint_path):
@@ -361,15 +654,41 @@ def save_checkpoint(model, optimizer, epoch, val_loss, checkpoint_path):
     torch.save(checkpoint, f'model_checkpoint_epoch_{epoch}.pt')
     print(f"Checkpoint saved for epoch {epoch} with validation loss {val_loss:.4f}")
 
+# Function to convert a state_dict saved with one Head module per attention head to the fused qkv layout
+def upgrade_state_dict(state_dict):
+    upgraded, head_weights = {}, {}
+    for key, value in state_dict.items():
+        parts = key.split('.')  # blocks.N.sa.heads.H.{query,key,value}.weight or blocks.N.sa.heads.H.tril
+        if len(parts) > 5 and parts[2] == 'sa' and parts[3] == 'heads':
+            if parts[5] != 'tril':
+                head_weights.setdefault('.'.join(parts[:3]), {})[(parts[5], int(parts[4]))] = value
+        else:
+            upgraded[key] = value
+    for prefix, weights in head_weights.items():
+        num_heads = len(weights) // 3
+        # qkv rows are laid out as every query head, then every key head, then every value head
+        upgraded[f'{prefix}.qkv.weight'] = torch.cat([weights[(name, h)] for name in ('query', 'key', 'value')
+                                                      for h in range(num_heads)])
+    return upgraded, bool(head_weights)
+
 def load_checkpoint(model, optimizer, checkpoint_path='checkpoint.pth'):
         checkpoint = torch.load(checkpoint_path)
-        model.load_state_dict(checkpoint['model_state_dict'])
-        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        state_dict, upgraded = upgrade_state_dict(checkpoint['model_state_dict'])
+        model.load_state_dict(state_dict)
+        if upgraded:
+            # The old optimizer state is keyed to the per-head parameters, so it cannot follow them into qkv
+            print("Converted per-head attention weights from an older checkpoint; optimizer state was reset")
+        else:
+            try:
+                optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            except ValueError:
+                print("Saved optimizer state does not match the model; optimizer state was reset")
         start_epoch = checkpoint['epoch'] + 1
         val_loss = checkpoint['val_loss']
         print(f"Checkpoint loaded. Resuming from epoch {start_epoch} with validation loss {val_loss:.4f}")
         return start_epoch, val_loss
 
     
-# Example usage to train the model
+# Example usage to search hyperparameters and train the model
+#hyperparameter_search(n_trials=50)
 train_model(epochs=50)
@@ -1,14 +1,22 @@
+import os
+# Expandable segments stop the CUDA caching allocator fragmenting as optimizers are swapped; must be set before torch loads
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:128')
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 import torch.nn.utils.prune as prune
-import mmap
 import random
+import queue
+import json
+import threading
 import pickle
 import re
+import inspect
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from pytorch_lamb import Lamb
-from torch.cuda.amp import autocast, GradScaler
+from torch.amp import GradScaler
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 # Check if CUDA is available and if so, set the device accordingly
@@ -16,6 +24,12 @@ device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 print(device)
 torch.cuda.empty_cache()
 
+# Let FP32 matmuls and convolutions use TF32 tensor cores and autotune cuDNN kernels
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision('high')
+
 # Define the parameters for the model and training
 block_size = 192
 batch_size = 64
@@ -28,6 +42,22 @@ n_head = 8
 dropout = 0.3
 warmup_iters = 5000
 
+# Attention kernels in order of preference; FlashAttention needs fp16/bf16 and a supported head size
+attention_backends = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+
+# FlashAttention kernels only serve these head sizes; others silently fall back to a slower kernel
+flash_head_sizes = (32, 64, 96, 128)
+if n_embd % n_head or n_embd // n_head not in flash_head_sizes:
+    print(f"Warning: head size {n_embd / n_head:g} (n_embd / n_head) cannot use FlashAttention, "
+          f"pick n_head so it is one of {flash_head_sizes}")
+
+# BF16 autocast (Ampere and newer) needs no loss scaling; older GPUs fall back to FP16 with a GradScaler
+use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+
+# The fused AdamW updates every parameter in a single CUDA kernel; older torch versions lack the option
+adamw_fused = torch.cuda.is_available() and 'fused' in inspect.signature(torch.optim.AdamW).parameters
+
 # Define the learning rates and optimizers to test
 learning_rates = [3.5e-4, 1e-4, 5e-5, 1e-5, 7e-6, 3e-5, 5e-6]  # Added more learning rates
 optimizers = [ 'SGD', 'AdamW', 'RMSprop', 'Adagrad']
@@ -63,6 +93,17 @@ int_to_string = {i: ch for i, ch in enumerate(cleaned_chars)}
 encode = lambda s: [string_to_int.get(c, string_to_int[' ']) for c in s]  # default to space for unknown chars
 decode = lambda l: ''.join([int_to_string[i] for i in l])
 
+# Byte-to-token lookup table for vectorized encoding of ASCII text; unknown characters map to space like encode
+encode_lut = np.full(256, string_to_int[' '], dtype=np.uint16)
+for ch, i in string_to_int.items():
+    if ord(ch) < 128:
+        encode_lut[ord(ch)] = i
+
+def encode_np(text):
+    if text.isascii():
+        return encode_lut[np.frombuffer(text.encode('ascii'), dtype=np.uint8)]
+    return np.asarray(encode(text), dtype=np.uint16)  # Multi-byte characters need the per-character path
+
 def clean_text(text):
     # Remove null values
     text = text.replace('\x00', '')
@@ -96,77 +137,168 @@ def clean_text(text):
     
     return text
 
-def get_random_chunk(split):
-    filename = "training_data/train_split.txt" if split == 'train' else "training_data/val_split.txt"
-    while True:
-        with open(filename, 'rb') as f:
-            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-                file_size = len(mm)
-                start_pos = random.randint(0, file_size - block_size * batch_size)
-                mm.seek(start_pos)
-                block = mm.read(block_size * batch_size - 1)
-                decoded_block = block.decode('utf-8', errors='ignore').replace('\r', '')
-                cleaned_block = clean_text(decoded_block)
-                
-                # Check if cleaned_block is empty
-                if cleaned_block:
-                    data = torch.tensor(encode(cleaned_block), dtype=torch.long)
-                
-                    # Ensure data length is greater than block_size
-                    if len(data) > block_size:
-                        break  # Found a suitable chunk, exit the loop
-                else:
-                    print("Cleaned block is empty, retrying...")
-    
-    return data
-
+# Text files and this trainer's token caches; ids are stored as uint16 since the vocabulary fits in 16 bits
+data_files = {
+    'train': ("training_data/train_split.txt", "training_data/train_char.bin"),
+    'val': ("training_data/val_split.txt", "training_data/val_char.bin"),
+}
+cache_chunk_size = 1024 * 1024  # characters encoded at a time while building a cache
+prefetch_depth = 4  # batches kept ready per split
+cache_format = 2  # Bump whenever the way text is encoded changes, so existing caches are rebuilt
+cache_vocab = ''.join(cleaned_chars)  # Recorded with each cache; a changed vocab.txt forces a rebuild
+
+def read_cache_key(cache_path):
+    try:
+        with open(cache_path + '.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def read_text_chunks(text_path):
+    with open(text_path, 'r', encoding='utf-8', errors='ignore') as src:
+        carry = ''
+        while True:
+            chunk = src.read(cache_chunk_size)
+            if not chunk:
+                break
+            chunk = carry + chunk
+            cut = max(chunk.rfind(' '), chunk.rfind('\n'))
+            if cut <= 0:
+                carry = chunk  # No whitespace to cut at yet, keep reading
+                continue
+            yield chunk[:cut]
+            carry = chunk[cut:]
+        if carry:
+            yield carry
+
+
+def write_token_cache(text_path, cache_path, key):
+    print(f"Building token cache {cache_path} from {text_path}...")
+    with open(cache_path + '.tmp', 'wb') as dst:
+        separator = ''
+        for chunk in read_text_chunks(text_path):
+            cleaned = clean_text(chunk.replace('\r', ''))
+            if cleaned:
+                # clean_text strips each chunk's edges, so restore the space between consecutive chunks
+                encode_np(separator + cleaned).tofile(dst)
+                separator = ' '
+    os.replace(cache_path + '.tmp', cache_path)
+    with open(cache_path + '.json', 'w', encoding='utf-8') as f:
+        json.dump(key, f)
+
+
+def build_token_cache(split):
+    text_path, cache_path = data_files[split]
+    stat = os.stat(text_path)
+    key = {'format': cache_format, 'vocab': cache_vocab, 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if not os.path.exists(cache_path) or read_cache_key(cache_path) != key:
+        write_token_cache(text_path, cache_path, key)
+
+    data = np.memmap(cache_path, dtype=np.uint16, mode='r')
+    if len(data) and data.max() >= vocab_size:
+        print(f"{cache_path} holds ids outside the vocabulary, rebuilding...")
+        del data  # Release the mapping so the file can be replaced
+        write_token_cache(text_path, cache_path, key)
+        data = np.memmap(cache_path, dtype=np.uint16, mode='r')
 
-def get_batch(split):
-    data = get_random_chunk(split)
-    
     if len(data) <= block_size:
-        raise ValueError("Data length is less than or equal to block_size, cannot generate batch.")
+        raise ValueError(f"{cache_path} holds {len(data)} tokens, not enough for a block of {block_size}.")
+    return data
 
-    ix = torch.randint(0, len(data) - block_size, (batch_size,))
-    x = torch.stack([data[i:i + block_size] for i in ix])
-    y = torch.stack([data[i + 1:i + block_size + 1] for i in ix])
-    x, y = x.to(device), y.to(device)  # Move data to the correct device
-    return x, y
 
+def sample_batch(split, rng):
+    data = train_data if split == 'train' else val_data
+    ix = rng.integers(0, len(data) - block_size, size=batch_size)
+    # Every (block_size + 1)-token window as a strided view, gathered in one copy; inputs and targets are
+    # its first and last block_size tokens
+    windows = sliding_window_view(data, block_size + 1)
+    # Widened only to int32 here (int64 would quadruple the transfer); pinned host memory lets the copy to
+    # the GPU run asynchronously
+    batch = torch.empty((batch_size, block_size + 1), dtype=torch.int32, pin_memory=device.type == 'cuda')
+    batch.numpy()[:] = windows[ix]
+    return batch
+
+
+class BatchPrefetcher:
+    def __init__(self, split, seed, depth=prefetch_depth):
+        self.split = split
+        # A private generator, so batch order follows the seed whatever the main thread does with np.random
+        self.rng = np.random.default_rng(seed)
+        self.batches = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self._fill, daemon=True)
+        self.worker.start()
+
+    def _fill(self):
+        try:
+            while not self.stopped.is_set():
+                self.batches.put(sample_batch(self.split, self.rng))
+        except Exception as e:
+            self.batches.put(e)  # Re-raised by the training loop instead of hanging it
+
+    def close(self):
+        self.stopped.set()
+        # Empty the queue so a worker blocked on a full queue can finish its put and see the flag
+        while True:
+            try:
+                self.batches.get_nowait()
+            except queue.Empty:
+                break
+
+    def __next__(self):
+        batch = self.batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        batch = batch.to(device, non_blocking=True).long()  # Embedding and cross-entropy want int64 ids
+        return batch[:, :-1].contiguous(), batch[:, 1:].contiguous()
+
+
+batch_prefetchers = {}
+
+def start_prefetchers(seed):
+    # Restart the prefetch threads with generators derived from seed, dropping batches already queued
+    for prefetcher in batch_prefetchers.values():
+        prefetcher.close()
+    for i, split in enumerate(data_files):
+        batch_prefetchers[split] = BatchPrefetcher(split, seed=[seed, i])
 
-class Head(nn.Module):
-    def __init__(self, head_size):
-        super().__init__()
-        self.key = nn.Linear(n_embd, head_size, bias=False)
-        self.query = nn.Linear(n_embd, head_size, bias=False)
-        self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)))
-        self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
-        B, T, C = x.shape
-        k = self.key(x)
-        q = self.query(x)
-        wei = q @ k.transpose(-2, -1) * k.shape[-1] ** -0.5
-        wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf'))
-        wei = F.softmax(wei, dim=-1)
-        wei = self.dropout(wei)
-        v = self.value(x)
-        out = wei @ v
-        return out
+def get_batch(split):
+    return next(batch_prefetchers[split])
 
 
 class MultiHeadAttention(nn.Module):
     def __init__(self, num_heads, head_size):
         super().__init__()
-        self.heads = nn.ModuleList([Head(head_size) for _ in range(num_heads)])
+        self.num_heads = num_heads
+        self.head_size = head_size
+        # One fused projection for query, key and value of every head
+        self.qkv = nn.Linear(n_embd, 3 * num_heads * head_size, bias=False)
         self.proj = nn.Linear(head_size * num_heads, n_embd)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
+    def forward(self, x, past_kv=None):
+        B, T, C = x.shape
+        # One GEMM for all heads, then a single reshape to (3, B, nh, T, hs)
+        qkv = self.qkv(x).view(B, T, 3, self.num_heads, self.head_size).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        attn_mask = None
+        if past_kv is not None:
+            # Incremental decoding: new tokens attend to every cached position and to the new tokens before them;
+            # a single new token may see everything, so it needs no mask at all
+            past_len = past_kv[0].size(2)
+            k = torch.cat((past_kv[0], k), dim=2)
+            v = torch.cat((past_kv[1], v), dim=2)
+            if T > 1:
+                # Built only on this rarely used path; is_causal covers the uncached one
+                attn_mask = torch.ones(T, past_len + T, dtype=torch.bool, device=q.device).tril(diagonal=past_len)
+        with sdpa_kernel(attention_backends):
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, is_causal=past_kv is None,
+                                                 dropout_p=dropout if self.training else 0.0)
+        out = out.transpose(1, 2).reshape(B, T, self.num_heads * self.head_size)
         out = self.dropout(self.proj(out))
-        return out
+        return out, (k, v)
 
 
 class FeedFoward(nn.Module):
@@ -192,12 +324,12 @@ class Block(nn.Module):
         self.ln1 = nn.LayerNorm(n_embd)
         self.ln2 = nn.LayerNorm(n_embd)
 
-    def forward(self, x):
-        y = self.sa(x)
+    def forward(self, x, past_kv=None):
+        y, present_kv = self.sa(x, past_kv)
         x = self.ln1(x + y)
         y = self.ffwd(x)
         x = self.ln2(x + y)
-        return x
+        return x, present_kv
 
 
 class GPTLanguageModel(nn.Module):
@@ -205,9 +337,11 @@ class GPTLanguageModel(nn.Module):
         super().__init__()
         self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
         self.position_embedding_table = nn.Embedding(block_size, n_embd)
-        self.blocks = nn.Sequential(*[Block(n_embd, n_head=n_head) for _ in range(n_layer)])
+        self.register_buffer('pos_ids', torch.arange(block_size), persistent=False)
+        self.blocks = nn.ModuleList([Block(n_embd, n_head=n_head) for _ in range(n_layer)])
         self.ln_f = nn.LayerNorm(n_embd)
         self.lm_head = nn.Linear(n_embd, vocab_size)
+        self.lm_head.weight = self.token_embedding_table.weight  # Tie the output projection to the input embedding
         self.apply(self._init_weights)
 
     def _init_weights(self, module):
@@ -218,12 +352,17 @@ class GPTLanguageModel(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, index, targets=None):
+    def forward(self, index, targets=None, past_kv=None):
+        # past_kv is a per-layer list of cached (key, value) pairs, None for an empty layer; it is updated in place
         B, T = index.shape
+        past_len = 0 if past_kv is None or past_kv[0] is None else past_kv[0][0].size(2)
         tok_emb = self.token_embedding_table(index)
-        pos_emb = self.position_embedding_table(torch.arange(T, device=device))
+        pos_emb = self.position_embedding_table(self.pos_ids[past_len:past_len + T])
         x = tok_emb + pos_emb
-        x = self.blocks(x)
+        for i, block in enumerate(self.blocks):
+            x, present_kv = block(x, None if past_kv is None else past_kv[i])
+            if past_kv is not None:
+                past_kv[i] = present_kv
         x = self.ln_f(x)
         logits = self.lm_head(x)
         if targets is None:
@@ -235,16 +374,30 @@ class GPTLanguageModel(nn.Module):
             loss = F.cross_entropy(logits, targets)
         return logits, loss
 
-    def generate(self, index, max_new_tokens):
+    @torch.no_grad()
+    def generate(self, index, max_new_tokens, top_k=50):
+        past_kv = None
         for _ in range(max_new_tokens):
-            index_cond = index[:, -block_size:]
-            logits, loss = self.forward(index_cond)
+            if past_kv is None or index.size(1) > block_size:
+                # Prime the cache; past block_size the positions shift every step, so recompute the window
+                past_kv = [None] * len(self.blocks)
+                logits, loss = self.forward(index[:, -block_size:], past_kv=past_kv)
+            else:
+                # Only the newest token needs a forward pass, earlier keys and values come from the cache
+                logits, loss = self.forward(index[:, -1:], past_kv=past_kv)
             logits = logits[:, -1, :]
-            probs = F.softmax(logits, dim=-1)
-            index_next = torch.multinomial(probs, num_samples=1)
+            # Sample among the top_k most likely tokens only, so softmax and multinomial run over k entries
+            top_logits, top_index = torch.topk(logits, k=min(top_k, logits.size(-1)), dim=-1)
+            probs = F.softmax(top_logits, dim=-1)
+            index_next = top_index.gather(-1, torch.multinomial(probs, num_samples=1))
             index = torch.cat((index, index_next), dim=1)
         return index
 
+# Tokenize both splits once up front
+train_data = build_token_cache('train')
+val_data = build_token_cache('val')
+start_prefetchers(37)
+
 # Load the model and optimizer state
 model = GPTLanguageModel(vocab_size)
 print('Loading model parameters...')
@@ -255,15 +408,27 @@ try:
     print('Loaded successfully!')
 except FileNotFoundError:
     print('No pre-trained model found, starting from scratch.')
+except (AttributeError, pickle.UnpicklingError):
+    # Models pickled before attention moved to a fused qkv projection reference the removed Head class
+    print('Saved model is incompatible with the current architecture, starting from scratch.')
 
 # Move the model to the appropriate device (GPU or CPU)
 model = model.to(device)
 
-# Apply model pruning
+# Apply model pruning; lm_head is skipped since its weight is tied to the token embedding
 for name, module in model.named_modules():
-    if isinstance(module, nn.Linear):
+    if isinstance(module, nn.Linear) and module is not model.lm_head:
         prune.l1_unstructured(module, name='weight', amount=0.2)
 
+# Forward pass under autocast for training and loss estimation; the eager model is kept for pickling and generation
+def train_step(model, inputs, targets):
+    with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=device.type == 'cuda'):
+        logits, loss = model(inputs, targets)
+    return loss
+
+# Compiled once so autocast entry/exit lives inside the CUDA graph; dynamo specializes it per model
+compiled_train_step = torch.compile(train_step, mode='reduce-overhead', fullgraph=False)
+
 #set_seed(37)  # Ensure reproducibility
 def set_seed(seed):
     random.seed(seed)
@@ -271,6 +436,7 @@ def set_seed(seed):
     torch.manual_seed(seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
+    start_prefetchers(seed)  # Batch sampling restarts from the new seed
 
 # Define the loss estimation function
 @torch.no_grad()
@@ -278,12 +444,12 @@ def estimate_loss():
     model.eval()
     out = {}
     for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
+        total_loss = torch.zeros((), device=device)  # Accumulated on the device to avoid a sync per batch
         for k in range(eval_iters):
             X, Y = get_batch(split)
-            logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
+            loss = compiled_train_step(model, X, Y)
+            total_loss += loss.detach()
+        out[split] = (total_loss / eval_iters).item()
     model.train()
     return out
 
@@ -293,7 +459,7 @@ def get_optimizer(name, parameters, learning_rate):
     elif name == 'SGD':
         return torch.optim.SGD(parameters, lr=learning_rate)
     elif name == 'AdamW':
-        return torch.optim.AdamW(parameters, lr=learning_rate)
+        return torch.optim.AdamW(parameters, lr=learning_rate, fused=adamw_fused)
     elif name == 'RMSprop':
         return torch.optim.RMSprop(parameters, lr=learning_rate)
     elif name == 'Adagrad':
@@ -307,7 +473,7 @@ current_lr_idx = 0
 
 current_optimizer = get_optimizer(optimizers[current_optimizer_idx], model.parameters(), learning_rates[current_lr_idx])
 scheduler = ReduceLROnPlateau(current_optimizer, mode='min', factor=0.5, patience=3, verbose=True)
-scaler = GradScaler()
+scaler = GradScaler('cuda', enabled=not use_bf16)
 
 patience = 5  # Number of cycles through all learning rates and optimizers before stopping if no improvement
 best_val_loss = float('inf')
@@ -318,23 +484,23 @@ for step in range(max_iters):
     X, Y = get_batch('train')
 
     # Perform the forward pass and calculate loss under autocast
-    with autocast():
-        logits, loss = model(X, Y)
+    loss = compiled_train_step(model, X, Y)
 
     # Scale the loss for mixed-precision training
     scaler.scale(loss).backward()
 
-    # Gradient clipping
+    # Gradient clipping on the unscaled gradients
+    scaler.unscale_(current_optimizer)
     torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
 
-    # Unscale the gradients and call optimizer.step()
+    # Call optimizer.step(), skipped if FP16 gradients overflowed
     scaler.step(current_optimizer)
 
     # Update the scale for next iteration
     scaler.update()
 
     # Zero the gradients
-    current_optimizer.zero_grad()
+    current_optimizer.zero_grad(set_to_none=True)
     
     if step % eval_interval == 0:
         losses = estimate_loss()